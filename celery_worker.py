@@ -1,31 +1,194 @@
 import csv
+import os
+import uuid
 
-from celery import Celery
+import pyarrow as pa
+from celery import Celery, chord
 from celery.utils.log import get_task_logger
+from pyarrow import csv as pa_csv
+from sqlalchemy import text
 
-from models import PricingFeed, SessionLocal
+from models import engine
 
 logger = get_task_logger(__name__)
 
-app = Celery("tasks", broker="redis://localhost:6379/0")
+app = Celery("tasks", broker="redis://localhost:6379/0", backend="redis://localhost:6379/1")
+app.conf.update(
+    broker_transport_options={"visibility_timeout": 3600, "socket_keepalive": True},
+    # Long CSV loads: ack only once done, and don't let one worker hoard queued files
+    task_acks_late=True,
+    worker_prefetch_multiplier=1,
+    # CSV ingest gets its own queue so its worker pool can be scaled separately
+    task_routes={"celery_worker.*": {"queue": "ingest"}},
+)
 
+# CSV header -> pricing_feeds column, in the order COPY expects them
+CSV_COLUMNS = {
+    "Store ID": "store_id",
+    "SKU": "sku",
+    "Product Name": "product_name",
+    "Price": "price",
+    "Date": "date",
+}
+# Keep identifiers as text; inferred types would turn e.g. SKU "0042" into the integer 42.
+# Prices and dates are parsed once here, so bad values fail at parse time, not inside COPY.
+CSV_COLUMN_TYPES = {
+    "Store ID": pa.string(),
+    "SKU": pa.string(),
+    "Product Name": pa.string(),
+    "Price": pa.float64(),
+    "Date": pa.date32(),
+}
+READ_BLOCK_SIZE = 8 << 20
+# Files are only split into parallel chunks of at least this size
+MIN_CHUNK_SIZE = 16 << 20
+PROGRESS_INTERVAL = 10_000
+FEED_COLUMNS = ", ".join(CSV_COLUMNS.values())
+COPY_SQL = "COPY {table} (" + FEED_COLUMNS + ") FROM STDIN WITH (FORMAT csv)"
 
-@app.task
-def process_csv_file(file_path):
-    db = SessionLocal()
+
+def open_csv(source, column_names=None):
+    """
+    Streaming pyarrow CSV reader over the upload, yielding RecordBatches of
+    roughly READ_BLOCK_SIZE bytes with only the mapped columns, in CSV_COLUMNS order.
+    Pass column_names when the source has no header line (a chunk of the file).
+    """
+    return pa_csv.open_csv(
+        source,
+        read_options=pa_csv.ReadOptions(block_size=READ_BLOCK_SIZE, column_names=column_names),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=list(CSV_COLUMNS),
+            column_types=CSV_COLUMN_TYPES,
+        ),
+    )
+
+
+def copy_batches(cur, batches, table, task_id=None):
+    """
+    COPY each RecordBatch into `table` (pricing_feeds or a staging table).
+    Batches are re-encoded as header-less CSV by pyarrow, so the rows never
+    become Python objects. Returns the number of rows loaded.
+    """
+    row_count = 0
+    next_progress = PROGRESS_INTERVAL
+    for batch in batches:
+        sink = pa.BufferOutputStream()
+        pa_csv.write_csv(batch, sink, write_options=pa_csv.WriteOptions(include_header=False))
+        cur.copy_expert(COPY_SQL.format(table=table), pa.BufferReader(sink.getvalue()))
+        row_count += batch.num_rows
+        if row_count >= next_progress:
+            logger.info("Task %s: %d rows loaded", task_id, row_count)
+            next_progress = (row_count // PROGRESS_INTERVAL + 1) * PROGRESS_INTERVAL
+    return row_count
+
+
+def split_csv(file_path, chunks):
+    """
+    Split the CSV body (everything after the header line) into about `chunks`
+    byte ranges of similar size, each starting and ending on a line boundary.
+    Like the pyarrow reader, this assumes quoted values don't contain newlines.
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, "rb") as f:
+        f.readline()
+        offsets = [f.tell()]
+        step = (size - offsets[0]) // chunks
+        for i in range(1, chunks):
+            # Back up one byte so a target that already starts a line is kept
+            f.seek(max(offsets[0] + i * step - 1, offsets[-1]))
+            f.readline()
+            if offsets[-1] < f.tell() < size:
+                offsets.append(f.tell())
+    offsets.append(size)
+    return list(zip(offsets, offsets[1:]))
+
+
+def ingest_csv_file(file_path):
+    """
+    Queue an uploaded CSV for loading: one process_csv_chunk per byte range, run
+    in parallel, each into its own staging table, then finish_csv_file to merge
+    them into pricing_feeds in a single transaction.
+    Returns the AsyncResult of the final task.
+    """
+    chunks = max(1, min(os.cpu_count() or 1, os.path.getsize(file_path) // MIN_CHUNK_SIZE))
+    ranges = split_csv(file_path, chunks)
+    upload_id = uuid.uuid4().hex
+    staging_tables = [f"pricing_feeds_staging_{upload_id}_{i}" for i in range(len(ranges))]
+    header = [
+        process_csv_chunk.s(file_path, start, end, staging_table)
+        for (start, end), staging_table in zip(ranges, staging_tables)
+    ]
+    callback = finish_csv_file.s(file_path, staging_tables).on_error(discard_staging_tables.s(staging_tables))
+    return chord(header)(callback)
+
+
+@app.task(bind=True)
+def process_csv_chunk(self, file_path, start, end, staging_table):
+    """
+    COPY the rows in bytes [start, end) of the CSV into a fresh staging table.
+    The table is (re)created in the same transaction as the COPY, so a redelivered
+    chunk replaces its rows instead of adding them twice.
+    Returns the number of rows loaded.
+    """
+    with open(file_path, newline="", encoding="utf-8-sig") as f:
+        column_names = next(csv.reader(f))
+
+    row_count = 0
+    conn = engine.raw_connection()
     try:
-        with open(file_path, "r") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                logger.info(row)
-                record = PricingFeed(
-                    store_id=row["Store ID"],
-                    sku=row["SKU"],
-                    product_name=row["Product Name"],
-                    price=float(row["Price"]),
-                    date=row["Date"],
-                )
-                db.add(record)
-        db.commit()
+        with pa.memory_map(file_path) as source, conn.cursor() as cur:
+            # Bulk load: don't wait for the WAL flush on commit
+            cur.execute("SET LOCAL synchronous_commit = off")
+            cur.execute(f"DROP TABLE IF EXISTS {staging_table}")
+            cur.execute(
+                f"CREATE UNLOGGED TABLE {staging_table} AS SELECT {FEED_COLUMNS} FROM pricing_feeds WITH NO DATA"
+            )
+            if end > start:
+                source.seek(start)
+                chunk = pa.BufferReader(source.read_buffer(end - start))
+                row_count = copy_batches(cur, open_csv(chunk, column_names), staging_table, task_id=self.request.id)
+        conn.commit()
     finally:
-        db.close()
+        conn.close()
+    logger.info("Task %s: staged %d rows from %s [%d:%d]", self.request.id, row_count, file_path, start, end)
+    return row_count
+
+
+@app.task
+def finish_csv_file(row_counts, file_path, staging_tables):
+    """
+    Chord callback once all chunks are staged: move every staged row into
+    pricing_feeds and drop the staging tables in one transaction, then refresh
+    the planner statistics and remove the spool file. If any chunk fails this
+    doesn't run; discard_staging_tables cleans up and the file is kept.
+    """
+    with engine.begin() as conn:
+        conn.execute(text("SET LOCAL synchronous_commit = off"))
+        # The tables are dropped by the merge itself, so they are only missing
+        # when this callback is redelivered after it already committed
+        if conn.execute(text("SELECT to_regclass(:table)"), {"table": staging_tables[0]}).scalar() is None:
+            logger.warning("Staging tables for %s were already merged", file_path)
+        else:
+            for staging_table in staging_tables:
+                conn.execute(text(
+                    f"INSERT INTO pricing_feeds ({FEED_COLUMNS}) SELECT {FEED_COLUMNS} FROM {staging_table}"
+                ))
+                conn.execute(text(f"DROP TABLE {staging_table}"))
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE pricing_feeds"))
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    logger.info("Loaded %d rows from %s in %d chunks", sum(row_counts), file_path, len(row_counts))
+    return sum(row_counts)
+
+
+@app.task
+def discard_staging_tables(request, exc, traceback, staging_tables):
+    """
+    Error callback of the ingest chord: drop the staging tables of a failed
+    upload so none of its rows reach pricing_feeds.
+    """
+    logger.error("Ingest task %s failed (%s); discarding %d staging tables", request.id, exc, len(staging_tables))
+    with engine.begin() as conn:
+        for staging_table in staging_tables:
+            conn.execute(text(f"DROP TABLE IF EXISTS {staging_table}"))
@@ -1,18 +1,26 @@
-from typing import List
+import hashlib
+import shutil
+import tempfile
+import threading
+from typing import List, Optional
 
+from cachetools import TTLCache
 from fastapi import FastAPI, Depends, Query
-from fastapi import UploadFile, HTTPException
+from fastapi import UploadFile, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from sqlalchemy import func
+from sqlalchemy import func, lambda_stmt, select, text, update
 from sqlalchemy.orm import Session
 
-from celery_worker import process_csv_file
+from celery_worker import app as celery_app, ingest_csv_file
 from models import PricingFeed, SessionLocal, init_db, PricingFeedUpdate, PricingFeedResponse, PricingFeedCreate, \
     PaginatedPricingFeedResponse, UpdateRequest, SearchRequest
 
 app = FastAPI()
 
+# Uploads are spooled to disk in 1 MiB chunks instead of being read into memory
+COPY_BUFFER_SIZE = 1 << 20
+
 origins = [
     "http://localhost",
     "http://localhost:8080",
@@ -37,6 +45,111 @@ def get_db():
         db.close()
 
 
+RESPONSE_FIELDS = tuple(PricingFeedResponse.model_fields)
+# List endpoints select plain columns instead of hydrating PricingFeed entities
+FEED_COLUMNS = tuple(PricingFeed.__table__.c[name] for name in RESPONSE_FIELDS)
+
+
+def feed_by_id(feed_id: int):
+    """
+    SELECT of one PricingFeed by primary key, compiled once and cached by SQLAlchemy.
+    """
+    return lambda_stmt(lambda: select(PricingFeed).where(PricingFeed.id == feed_id))
+
+
+# Single-record reads: feed_id -> (PricingFeedResponse, ETag). Per process; entries are
+# dropped by the write endpoints and expire after a minute in any case.
+feed_cache = TTLCache(maxsize=10000, ttl=60)
+feed_cache_lock = threading.Lock()
+# Bumped by every invalidation; a read only caches its result if no write
+# invalidated entries while it was querying the database
+feed_cache_generation = 0
+
+
+def feed_etag(feed: PricingFeedResponse) -> str:
+    """
+    Weak ETag for a pricing feed: its ID plus a digest of the serialized record.
+    """
+    digest = hashlib.blake2b(feed.model_dump_json().encode(), digest_size=8).hexdigest()
+    return f'W/"{feed.id}:{digest}"'
+
+
+def invalidate_feeds(*feed_ids: int):
+    global feed_cache_generation
+    with feed_cache_lock:
+        feed_cache_generation += 1
+        for feed_id in feed_ids:
+            feed_cache.pop(feed_id, None)
+
+
+def estimated_total(db: Session) -> int:
+    """
+    Approximate row count of pricing_feeds from the planner statistics.
+    Falls back to COUNT(*) while the table has not been analyzed yet.
+    """
+    total = db.execute(
+        text("SELECT reltuples::bigint FROM pg_class WHERE relname = 'pricing_feeds'")
+    ).scalar()
+    if total is None or total <= 0:
+        total = db.execute(select(func.count()).select_from(PricingFeed)).scalar()
+    return total
+
+
+def paginate(db: Session, stmt, size: int, filtered: bool, page: int = None, after_id: int = None):
+    """
+    Run a paginated lambda_stmt over FEED_COLUMNS and build the paginated response.
+    Pages are fetched by keyset: rows with id > after_id, through the primary key
+    index. `page` switches to the deprecated OFFSET pagination.
+    The response models are built with model_construct, without validation.
+
+    Totals: unfiltered queries use the planner estimate. Filtered queries read it
+    from a COUNT(*) OVER () window column on the first keyset page and on OFFSET
+    pages; later keyset pages report no total, as counting would need a second scan.
+    """
+    skip = 0
+    if page is not None:
+        skip = (page - 1) * size
+        page_stmt = stmt + (lambda s: s.offset(skip).limit(size))
+    elif after_id is not None:
+        page_stmt = stmt + (lambda s: s.where(PricingFeed.id > after_id).limit(size))
+    else:
+        page_stmt = stmt + (lambda s: s.limit(size))
+
+    window_total = filtered and (page is not None or after_id is None)
+    if window_total:
+        page_stmt += lambda s: s.add_columns(func.count().over().label("total"))
+
+    rows = db.execute(page_stmt).all()
+
+    if not filtered:
+        total_count = estimated_total(db)
+    elif not window_total:
+        total_count = None
+    elif rows:
+        total_count = rows[0].total
+    elif skip:
+        # Page past the end: the window has no row to carry the total
+        total_count = db.execute(
+            stmt + (lambda s: s.with_only_columns(func.count(), maintain_column_froms=True).order_by(None))
+        ).scalar()
+    else:
+        total_count = 0
+
+    # Rows come straight from the database, so skip re-validating them
+    return PaginatedPricingFeedResponse.model_construct(
+        total_count=total_count,
+        page=page,
+        size=size,
+        total_pages=None if total_count is None else (total_count // size) + (1 if total_count % size > 0 else 0),
+        next_after_id=rows[-1].id if len(rows) == size else None,
+        results=[
+            # zip() stops before the trailing window total, if present
+            PricingFeedResponse.model_construct(**dict(zip(RESPONSE_FIELDS, row)))
+            for row in rows
+        ],
+    )
+
+
 @app.on_event("startup")
 async def startup_event():
     init_db()
@@ -54,77 +167,77 @@ async def say_hello(name: str):
 
 @app.post("/upload/")
 async def upload_csv(file: UploadFile, db: Session = Depends(get_db)):
-    file_location = f"/tmp/{file.filename}"
-    with open(file_location, "wb") as f:
-        f.write(file.file.read())
+    # Unique spool file per upload, so uploads with the same filename can't clobber
+    # each other; the worker deletes it once the rows are loaded
+    with tempfile.NamedTemporaryFile("wb", prefix="pricing_feed_", suffix=".csv", delete=False) as f:
+        shutil.copyfileobj(file.file, f, length=COPY_BUFFER_SIZE)
+    file_location = f.name
 
     # Trigger Celery task
-    task = process_csv_file.delay(file_location)
+    task = ingest_csv_file(file_location)
     return JSONResponse({"message": "File uploaded successfully", "task_id": task.id})
 
 
 @app.get("/status/{task_id}")
 def get_task_status(task_id: str):
-    from celery.result import AsyncResult
-    task_result = AsyncResult(task_id)
+    task_result = celery_app.AsyncResult(task_id)
     return {"task_id": task_id, "status": task_result.status}
 
 
-@app.post("/api/search/")
+@app.post("/api/search/", response_model=PaginatedPricingFeedResponse)
 async def search_records(
         search: SearchRequest,
-        page: int = Query(1, ge=1),
+        after_id: Optional[int] = Query(None, ge=0, description="Return records with ID greater than this cursor"),
+        page: Optional[int] = Query(None, ge=1, deprecated=True, description="OFFSET pagination; use after_id"),
         size: int = Query(10, ge=1),
         db: Session = Depends(get_db),
 ):
     print("search", search)
-    query = db.query(PricingFeed)
+    # Filters are appended as lambdas so each combination compiles once and is
+    # reused from the statement cache; closure variables become bound parameters
+    stmt = lambda_stmt(lambda: select(*FEED_COLUMNS))
+    filtered = False
 
     # Store ID Filter
     if search.store_id:
-        query = query.filter(PricingFeed.store_id == search.store_id)
+        store_id = search.store_id
+        stmt += lambda s: s.where(PricingFeed.store_id == store_id)
+        filtered = True
 
-    # SKU Search (Case-Insensitive)
+    # SKU Search (Case-Insensitive, served by the trigram index)
     if search.search_sku:
-        search_text = search.search_sku.lower()
-        query = query.filter(func.lower(PricingFeed.sku).like(f"%{search_text}%"))
+        sku_pattern = f"%{search.search_sku}%"
+        stmt += lambda s: s.where(PricingFeed.sku.ilike(sku_pattern))
+        filtered = True
 
-    # Product Name Search (Case-Insensitive)
+    # Product Name Search (Case-Insensitive, served by the trigram index)
     if search.search_product_name:
-        search_text = search.search_product_name.lower()
-        query = query.filter(func.lower(PricingFeed.product_name).like(f"%{search_text}%"))
+        product_name_pattern = f"%{search.search_product_name}%"
+        stmt += lambda s: s.where(PricingFeed.product_name.ilike(product_name_pattern))
+        filtered = True
 
     # Price Range Filters
-    if search.search_price_from is not None and search.search_price_to is not None:
-        query = query.filter(
-            PricingFeed.price.between(search.search_price_from, search.search_price_to)
-        )
-    elif search.search_price_from is not None:
-        query = query.filter(PricingFeed.price >= search.search_price_from)
+    price_from, price_to = search.search_price_from, search.search_price_to
+    if price_from is not None and price_to is not None:
+        stmt += lambda s: s.where(PricingFeed.price.between(price_from, price_to))
+        filtered = True
+    elif price_from is not None:
+        stmt += lambda s: s.where(PricingFeed.price >= price_from)
+        filtered = True
 
     # Date Range Filters
-    if search.search_date_from and search.search_date_to:
-        query = query.filter(
-            PricingFeed.date.between(search.search_date_from, search.search_date_to)
-        )
-    elif search.search_date_from:
-        query = query.filter(PricingFeed.date >= search.search_date_from)
+    date_from, date_to = search.search_date_from, search.search_date_to
+    if date_from and date_to:
+        stmt += lambda s: s.where(PricingFeed.date.between(date_from, date_to))
+        filtered = True
+    elif date_from:
+        stmt += lambda s: s.where(PricingFeed.date >= date_from)
+        filtered = True
 
     # Sort by ID in Ascending Order
-    query = query.order_by(PricingFeed.id)
-
-    # Get Total Count for Pagination
-    total_count = query.count()
-    skip = (page - 1) * size
-    feeds = query.offset(skip).limit(size).all()
+    stmt += lambda s: s.order_by(PricingFeed.id)
 
-    return {
-        "total_count": total_count,
-        "page": page,
-        "size": size,
-        "total_pages": (total_count // size) + (1 if total_count % size > 0 else 0),
-        "results": feeds,
-    }
+    return paginate(db, stmt, size, filtered, page=page, after_id=after_id)
 
 
 @app.post("/api/pricing_feeds/bulk_update")
@@ -136,29 +249,30 @@ def bulk_update_pricing_feeds(
     Bulk update pricing feed records.
     Accepts a list of updates and modifies multiple records in a single request.
     """
-    updated_records = []
+    ids = [item.id for item in updates]
 
-    for update in updates:
-        db_feed = db.query(PricingFeed).filter(PricingFeed.id == update.id).first()
+    with db.begin():
+        # One lookup for every ID instead of a SELECT per record
+        existing_ids = set(db.execute(
+            lambda_stmt(lambda: select(PricingFeed.id).where(PricingFeed.id.in_(ids)))
+        ).scalars())
+        for feed_id in ids:
+            if feed_id not in existing_ids:
+                raise HTTPException(status_code=404, detail=f"Pricing feed with ID {feed_id} not found")
 
-        if not db_feed:
-            raise HTTPException(status_code=404, detail=f"Pricing feed with ID {update.id} not found")
-
-        for key, value in update.dict(exclude_unset=True).items():
-            setattr(db_feed, key, value)
-
-        updated_records.append(db_feed)
-
-    db.commit()
-    return {"message": f"{len(updated_records)} records updated successfully"}
+        # ORM bulk UPDATE by primary key, sent as a single executemany
+        if updates:
+            db.execute(update(PricingFeed), [item.dict(exclude_unset=True) | {"id": item.id} for item in updates])
+    invalidate_feeds(*ids)
+    return {"message": f"{len(updates)} records updated successfully"}
 
 
 # Create a new pricing feed
 @app.post("/api/pricing_feeds/", response_model=PricingFeedResponse)
 def create_pricing_feed(feed: PricingFeedCreate, db: Session = Depends(get_db)):
     db_feed = PricingFeed(**feed.dict())
-    db.add(db_feed)
-    db.commit()
+    with db.begin():
+        db.add(db_feed)
     db.refresh(db_feed)
     return db_feed
 
@@ -167,40 +281,49 @@ def create_pricing_feed(feed: PricingFeedCreate, db: Session = Depends(get_db)):
 @app.get("/api/pricing_feeds/", response_model=PaginatedPricingFeedResponse)
 def get_pricing_feeds(
         db: Session = Depends(get_db),
-        page: int = Query(1, ge=1),
+        after_id: Optional[int] = Query(None, ge=0, description="Return records with ID greater than this cursor"),
+        page: Optional[int] = Query(None, ge=1, deprecated=True, description="OFFSET pagination; use after_id"),
         size: int = Query(10, ge=1),
         store_id: str = Query(None, description="Filter by Store ID")
 ):
     """
     Fetch paginated pricing feeds with total record count.
     If store_id is provided, only count records for that store.
+    Pass next_after_id back as after_id to fetch the next page.
     """
-    query = db.query(PricingFeed)
+    stmt = lambda_stmt(lambda: select(*FEED_COLUMNS))
 
     if store_id:
-        query = query.filter(PricingFeed.store_id == store_id)
-
-    query = query.order_by(getattr(PricingFeed, 'id'))  # Ascending sort
+        stmt += lambda s: s.where(PricingFeed.store_id == store_id)
 
-    total_count = query.count()  # Count records based on filter
-    skip = (page - 1) * size
-    feeds = query.offset(skip).limit(size).all()
+    stmt += lambda s: s.order_by(PricingFeed.id)  # Ascending sort
 
-    return {
-        "total_count": total_count,
-        "page": page,
-        "size": size,
-        "total_pages": (total_count // size) + (1 if total_count % size > 0 else 0),
-        "results": feeds,
-    }
+    return paginate(db, stmt, size, filtered=bool(store_id), page=page, after_id=after_id)
 
 
 # Get a single pricing feed
 @app.get("/api/pricing_feeds/{feed_id}", response_model=PricingFeedResponse)
-def get_pricing_feed(feed_id: int, db: Session = Depends(get_db)):
-    feed = db.query(PricingFeed).filter(PricingFeed.id == feed_id).first()
-    if not feed:
-        raise HTTPException(status_code=404, detail="Pricing feed not found")
+def get_pricing_feed(feed_id: int, request: Request, response: Response, db: Session = Depends(get_db)):
+    with feed_cache_lock:
+        cached = feed_cache.get(feed_id)
+        generation = feed_cache_generation
+    if cached is None:
+        db_feed = db.execute(feed_by_id(feed_id)).scalar_one_or_none()
+        if not db_feed:
+            raise HTTPException(status_code=404, detail="Pricing feed not found")
+        feed = PricingFeedResponse.model_validate(db_feed)
+        cached = (feed, feed_etag(feed))
+        with feed_cache_lock:
+            # A write invalidated entries during the read: caching now could
+            # re-insert the record it just replaced or deleted
+            if feed_cache_generation == generation:
+                feed_cache[feed_id] = cached
+
+    feed, etag = cached
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
     return feed
 
 
@@ -209,12 +332,13 @@ def get_pricing_feed(feed_id: int, db: Session = Depends(get_db)):
 def update_pricing_feed(
         feed_id: int, feed: PricingFeedUpdate, db: Session = Depends(get_db)
 ):
-    db_feed = db.query(PricingFeed).filter(PricingFeed.id == feed_id).first()
-    if not db_feed:
-        raise HTTPException(status_code=404, detail="Pricing feed not found")
-    for key, value in feed.dict(exclude_unset=True).items():
-        setattr(db_feed, key, value)
-    db.commit()
+    with db.begin():
+        db_feed = db.get(PricingFeed, feed_id)
+        if not db_feed:
+            raise HTTPException(status_code=404, detail="Pricing feed not found")
+        for key, value in feed.dict(exclude_unset=True).items():
+            setattr(db_feed, key, value)
+    invalidate_feeds(feed_id)
     db.refresh(db_feed)
     return db_feed
 
@@ -222,9 +346,10 @@ def update_pricing_feed(
 # Delete a pricing feed
 @app.delete("/api/pricing_feeds/{feed_id}")
 def delete_pricing_feed(feed_id: int, db: Session = Depends(get_db)):
-    db_feed = db.query(PricingFeed).filter(PricingFeed.id == feed_id).first()
-    if not db_feed:
-        raise HTTPException(status_code=404, detail="Pricing feed not found")
-    db.delete(db_feed)
-    db.commit()
+    with db.begin():
+        db_feed = db.get(PricingFeed, feed_id)
+        if not db_feed:
+            raise HTTPException(status_code=404, detail="Pricing feed not found")
+        db.delete(db_feed)
+    invalidate_feeds(feed_id)
     return {"message": "Pricing feed deleted successfully"}